@@ -1,12 +1,17 @@
 import csv
-import re
+from collections import Counter
+from itertools import chain, compress
 
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
+from scipy.optimize import minimize
+from scipy.sparse.csgraph import laplacian, shortest_path
+from scipy.sparse.linalg import eigsh
 
 
-def colorize(graph, node_name, node_color: str, font_color: str = 'black') -> None:
+def colorize(graph, node_name, node_color: str, font_color: str = 'black', **extra) -> None:
     """ノードの色つけを行う関数.
 
     Args:
@@ -14,11 +19,228 @@ def colorize(graph, node_name, node_color: str, font_color: str = 'black') -> No
         node_name (hashable): ノード名
         node_color (str): ノードにつけたい色
         font_color (str, optional): ラベルの色. Defaults to 'black'.
+        **extra: 色と合わせて設定したいその他のノード属性
     """
-    graph.nodes[node_name]['color'] = node_color
-    graph.nodes[node_name]['styled'] = 'filled'
-    graph.nodes[node_name]['fillcolor'] = node_color
-    graph.nodes[node_name]['fontcolor'] = font_color
+    d = graph.nodes[node_name]
+    d['color'] = node_color
+    d['styled'] = 'filled'
+    d['fillcolor'] = node_color
+    d['fontcolor'] = font_color
+    d.update(extra)
+
+
+def is_song(names: list) -> np.ndarray:
+    """全体曲の列かどうかを判定する関数.
+
+    全体曲は英単語から始まるので，先頭の1文字だけをNumPy配列にしてASCII英字かをまとめて判定する．
+
+    Args:
+        names (list): 判定したい文字列のリスト
+
+    Returns:
+        np.ndarray: 先頭がASCII英字ならTrueとなる真偽値の配列
+    """
+    first = np.array(names, dtype='U1')
+    return np.char.isalpha(first) & (first.view(np.uint32) < 0x80)
+
+
+def to_sparse_adjacency(graph) -> tuple:
+    """グラフを疎な隣接行列(CSR形式)に変換する関数.
+
+    Args:
+        graph (nx.Graph): 重み付き無向グラフ
+
+    Returns:
+        tuple: 行列の行番号に対応するノードのリストと対称な隣接行列(sp.csr_matrix)
+    """
+    nodes = list(graph)
+    idx = {node: i for i, node in enumerate(nodes)}
+
+    row, col, data = [], [], []
+    for u, v, w in graph.edges(data='weight', default=1):
+        row.append(idx[u])
+        col.append(idx[v])
+        data.append(w)
+
+    # 無向グラフなので(u, v)と(v, u)の両方を埋めて対称にする
+    n = len(nodes)
+    A = sp.csr_matrix((data + data, (row + col, col + row)), shape=(n, n), dtype=np.float64)
+    return nodes, A
+
+
+def _betweenness(A: sp.csr_matrix, D: np.ndarray) -> np.ndarray:
+    """全点対最短距離を使って媒介中心性を計算する関数(Brandesのアルゴリズム).
+
+    始点ごとに距離が同じノードを1つの階層にまとめ，最短経路数の前進計算と
+    依存度の逆伝播を階層単位の行列演算で行う．
+
+    Args:
+        A (sp.csr_matrix): 重みなしの対称な隣接行列
+        D (np.ndarray): 全点対の最短距離行列
+
+    Returns:
+        np.ndarray: 正規化済みの媒介中心性
+    """
+    n = A.shape[0]
+    betweenness = np.zeros(n)
+
+    for s in range(n):
+        dist = D[s]
+        max_dist = int(dist[np.isfinite(dist)].max())
+        if max_dist < 2:
+            continue  # 経由するノードがない
+        levels = [np.flatnonzero(dist == d) for d in range(max_dist + 1)]
+        # 隣り合う階層間のエッジだけが最短経路に乗る
+        links = [A[levels[d - 1]][:, levels[d]] for d in range(1, max_dist + 1)]
+
+        # 始点から各ノードまでの最短経路の本数
+        sigma = np.zeros(n)
+        sigma[s] = 1.0
+        for d in range(1, max_dist + 1):
+            sigma[levels[d]] = links[d - 1].T @ sigma[levels[d - 1]]
+
+        # 遠い階層から順に依存度を逆伝播
+        delta = np.zeros(n)
+        for d in range(max_dist, 0, -1):
+            coef = (1.0 + delta[levels[d]]) / sigma[levels[d]]
+            delta[levels[d - 1]] = sigma[levels[d - 1]] * (links[d - 1] @ coef)
+        delta[s] = 0.0
+        betweenness += delta
+
+    if n > 2:
+        betweenness /= (n - 1) * (n - 2)
+    return betweenness
+
+
+def average_clustering(A: sp.csr_matrix) -> float:
+    """平均クラスタリング係数を疎行列の積で計算する関数.
+
+    各ノードを含む三角形の数を(A @ A)とAの要素積の行和から求める．
+
+    Args:
+        A (sp.csr_matrix): 重みなしの対称な隣接行列
+
+    Returns:
+        float: 次数が1以下のノードを0として含めた平均クラスタリング係数
+    """
+    triangles = np.asarray((A @ A).multiply(A).sum(axis=1)).ravel() / 2
+    deg = np.asarray(A.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coef = np.where(deg > 1, 2 * triangles / (deg * (deg - 1)), 0.0)
+    return float(coef.mean())
+
+
+def compute_centralities(A: sp.csr_matrix) -> dict:
+    """次数・近接・媒介・固有ベクトル中心性をまとめて計算する関数.
+
+    全点対最短距離は1回だけ計算し，近接中心性と媒介中心性で共有する．
+
+    Args:
+        A (sp.csr_matrix): 重みなしの対称な隣接行列
+
+    Returns:
+        dict: 'degree', 'closeness', 'betweenness', 'eigenvector'をキーとした中心性の配列
+    """
+    n = A.shape[0]
+    D = shortest_path(A, directed=False, unweighted=True)
+
+    # 次数中心性(degree)．より多くのノードに接続している人ほど高スコア
+    degree = np.asarray(A.sum(axis=1)).ravel() / (n - 1)
+
+    # 近接中心性(Closeness)，全ての人と近い人が高スコア
+    # 非連結なグラフなので，到達可能なノード数で補正する(Wasserman and Faust)
+    reachable = np.isfinite(D)
+    n_reach = reachable.sum(axis=1) - 1
+    total_dist = np.where(reachable, D, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        closeness = np.where(total_dist > 0, n_reach / total_dist * n_reach / (n - 1), 0.0)
+
+    # 媒介中心性(Betweenness)．あるノードが他のノードの最短経路に含まれる度合い．様々なコミュニティに所属している人ほど高スコア
+    betweenness = _betweenness(A, D)
+
+    # 固有ベクトル中心性(Eigenvector centrality)，隣接するノードの中心性を加味する，他のポピュラーなノード中でポピュラーなものが高スコア
+    _, v = eigsh(A, k=1, which='LA')
+    eigenvector = np.abs(v[:, 0])
+
+    return {'degree': degree, 'closeness': closeness, 'betweenness': betweenness, 'eigenvector': eigenvector}
+
+
+def top_k(nodes: list, scores: np.ndarray, k: int = 3) -> list:
+    """スコアの上位k件を(ノード名, スコア)のリストで返す関数.
+
+    Args:
+        nodes (list): 行列の行番号に対応するノードのリスト
+        scores (np.ndarray): ノードごとのスコア
+        k (int, optional): 取り出す件数. Defaults to 3.
+
+    Returns:
+        list: スコアの降順に並んだ(ノード名, スコア)のリスト
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return []
+    # 全体をソートせず上位k件だけを取り出してから並べる
+    top = np.argpartition(-scores, k - 1)[:k]
+    order = top[np.argsort(-scores[top], kind='stable')]
+    return [(nodes[i], float(scores[i])) for i in order]
+
+
+def spring_layout_lbfgs(A: sp.csr_matrix, dim: int = 2, k: float = 0.3, gravity: float = 0.01,
+                        max_iter: int = 200, seed: int = None, dtype=np.float32) -> np.ndarray:
+    """Fruchterman-Reingold型のエネルギーをL-BFGSで最小化してノードの位置を決める関数.
+
+    nx.spring_layoutを固定回数反復する代わりに，エッジの重みによる吸引力
+    sum_ij w_ij * ||x_i - x_j||^2 とノード間の反発力 -k^2 * sum_ij log||x_i - x_j|| の和を
+    勾配付きで最小化する．非連結なグラフが発散しないように原点への弱い引力を加える．
+
+    Args:
+        A (sp.csr_matrix): 重み付きの対称な隣接行列
+        dim (int, optional): 配置する空間の次元. Defaults to 2.
+        k (float, optional): ノード間の最適な距離，大きいほど広がる. Defaults to 0.3.
+        gravity (float, optional): 原点への引力の強さ. Defaults to 0.01.
+        max_iter (int, optional): L-BFGSの最大反復回数. Defaults to 200.
+        seed (int, optional): 初期位置の乱数シード. Defaults to None.
+        dtype (np.dtype, optional): N×Nの距離行列を計算する型，表示用の位置ならfloat32で十分. Defaults to np.float32.
+
+    Returns:
+        np.ndarray: [-1, 1]に収まるよう正規化した(ノード数, dim)の位置
+    """
+    n = A.shape[0]
+    L = laplacian(sp.csr_matrix(A, dtype=dtype))
+    x0 = np.random.default_rng(seed).random((n, dim)).ravel()
+
+    def energy(x):
+        # L-BFGS-B自体はfloat64で動くので，N×Nの計算だけ指定の型で行う
+        X = np.ascontiguousarray(x.reshape(n, dim), dtype=dtype)
+        LX = L @ X
+        # |x|^2 + |y|^2 - 2x・y の形はfloat32だと近いノード間で桁落ちするので，
+        # 次元ごとの差分np.subtract.outerを1つのN×Nバッファに足し込んで距離を求める
+        dist2 = np.zeros((n, n), dtype=dtype)
+        for d in range(dim):
+            diff = np.subtract.outer(X[:, d], X[:, d])
+            diff *= diff
+            dist2 += diff
+        np.fill_diagonal(dist2, 1.0)  # 自分自身との距離はlog(1) = 0として無視する
+        dist2 = np.maximum(dist2, 1e-12)
+        inv = 1.0 / dist2
+        np.fill_diagonal(inv, 0.0)
+
+        # 和は精度が落ちないようfloat64で取る
+        e = (X * LX).sum(dtype=np.float64) - k ** 2 / 4 * np.log(dist2).sum(dtype=np.float64) \
+            + gravity * (X ** 2).sum(dtype=np.float64)
+        # 反発力の勾配 sum_j (x_i - x_j) / ||x_i - x_j||^2 を行列積でまとめて計算する
+        grad = 2 * LX - k ** 2 * (inv.sum(axis=1)[:, None] * X - inv @ X) + 2 * gravity * X
+        return e, grad.ravel().astype(np.float64)
+
+    res = minimize(energy, x0, jac=True, method='L-BFGS-B', options={'maxiter': max_iter})
+    pos = res.x.reshape(n, dim)
+
+    # nx.spring_layoutと同じく中心を原点に揃えて[-1, 1]に収める
+    pos = pos - pos.mean(axis=0)
+    lim = np.abs(pos).max()
+    if lim > 0:
+        pos = pos / lim
+    return pos
 
 
 if __name__ == '__main__':
@@ -29,36 +251,21 @@ if __name__ == '__main__':
 
     G = nx.Graph()  # 無向グラフ，有向はDiGraph
 
-    # アイドルのノードを作成
-    characters = list(set(sum(rows, [])))  # 一意なアイドルリスト
-    for character in characters:
-        # 全体曲の列は除外，全体曲は英単語から始まるので正規表現でマッチング
-        if re.match('[a-zA-Z]', character):
-            continue
-        else:
-            G.add_node(character)
-
-    # アイドルのエッジリストを作成
-    edges = []
-    for row in rows:
-        # 全体曲の列は除外，全体曲は英単語から始まるので正規表現でマッチング
-        if re.match('[a-zA-Z]', row[0]):
-            continue
-        else:
-            # センターと共演のアイドルに分ける
-            center, co_stars = row[0], row[1:]
-            # print(f'center: {center}, co-stars: {co_stars}')
-            for co_star in co_stars:
-                edges.append((center, co_star))
-            # break
-
-    # アイドルのエッジを作成
-    for node_a, node_b in edges:
-        # 既にエッジが存在する場合はエッジの重みを増加させる
-        if G.has_edge(node_a, node_b):
-            G.edges[node_a, node_b]['weight'] += 1
-        else:
-            G.add_edge(node_a, node_b, weight=1)
+    # アイドルのノードを作成，全体曲の列は除外
+    cells = list(chain.from_iterable(rows))
+    characters = set(compress(cells, ~is_song(cells)))  # 一意なアイドル集合
+    G.add_nodes_from(characters)
+
+    # 全体曲の行を除外，行ごとに列数が異なるので先頭の列だけで判定する
+    song_rows = is_song([row[0] for row in rows])
+
+    # アイドルのエッジを作成，(センター, 共演のアイドル)の組ごとに同時出演回数を数える
+    # 無向グラフなので組の並びは揃えておく
+    pairs = Counter(tuple(sorted((row[0], co_star)))
+                    for row in compress(rows, ~song_rows)
+                    for co_star in row[1:])
+    # 枝刈り，同時出演回数が一回のみのものは除外
+    G.add_weighted_edges_from((u, v, w) for (u, v), w in pairs.items() if w > 1)
 
     print(G.edges['春日未来', '天海春香'])  # weight=2
     print(G.edges['春日未来', '最上静香'])  # weight=4
@@ -66,20 +273,13 @@ if __name__ == '__main__':
     # colorize(G, '最上静香', 'blue')
     # colorize(G, '伊吹翼', 'yellow')
 
-    # 枝刈り，同時出演回数が一回のみのものは除外
-    for (u, v, d) in list(G.edges(data=True)):
-        if d['weight'] <= 1:
-            G.remove_edge(u, v)
-    # # エッジがなくなったノードを削除
-    # for character in characters:
-    #     if re.match('[a-zA-Z]', character):
-    #         continue
-    #     else:
-    #         if len(list(nx.all_neighbors(G, character))) == 0:
-    #             G.remove_node(character)
-
     # ノード間の反発力とエッジのweightの大きさによる吸引力でノードの位置が決定kが大きいほど円形に
-    pos = nx.spring_layout(G, k=0.3)
+    # ノード数が多い場合は疎行列上でL-BFGSによりエネルギーを最小化する
+    nodes, W = to_sparse_adjacency(G)
+    if len(G) > 500:
+        pos = dict(zip(nodes, spring_layout_lbfgs(W, k=0.3)))
+    else:
+        pos = nx.spring_layout(G, k=0.3)
 
     # # エッジの太さ調整
     # edge_width = [d['weight'] * 0.2 for (u, v, d) in G.edges(data=True)]
@@ -87,42 +287,35 @@ if __name__ == '__main__':
     # plt.axis('off')
     # plt.show()
 
+    # クラスタリング係数と中心性は重みなしで計算するので，隣接行列を0/1に変換しておく
+    A = (W > 0).astype(np.float64)
+
     # 基本的な情報を出力
-    print(nx.info(G))
+    print(f'Number of nodes: {A.shape[0]}')
+    print(f'Number of edges: {A.nnz // 2}')
+    print(f'Average degree: {A.nnz / A.shape[0]:.4f}')
     # print('Tsumugi\'s neighbors: ', list(nx.all_neighbors(G, '白石紬')))
 
     # クラスタリング係数
-    clustering_coef = nx.average_clustering(G)
+    clustering_coef = average_clustering(A)
 
-    # 次数中心性(degree)．より多くのノードに接続している人ほど高スコア
-    degrees = nx.degree_centrality(G)
-    degrees = sorted(degrees.items(), key=lambda x: x[1], reverse=True)
-
-    # 近接中心性(Closeness)，全ての人と近い人が高スコア
-    closeness = nx.closeness_centrality(G)
-    closeness = sorted(closeness.items(), key=lambda x: x[1], reverse=True)
-
-    # 媒介中心性(Betweenness)．あるノードが他のノードの最短経路に含まれる度合い．様々なコミュニティに所属している人ほど高スコア
-    betweenness = nx.betweenness_centrality(G)
-    betweenness = sorted(betweenness.items(), key=lambda x: x[1], reverse=True)
-
-    # 固有ベクトル中心性(Eigenvector centrality)，隣接するノードの中心性を加味する，他のポピュラーなノード中でポピュラーなものが高スコア
-    eigenvectors = nx.eigenvector_centrality(G)
-    eigenvectors = sorted(eigenvectors.items(), key=lambda x: x[1], reverse=True)
+    centralities = compute_centralities(A)
 
     print(f'Clustering coefficient: {clustering_coef}')  # クラスタ係数
-    print(f'より多くの人と関わりを持っているアイドル:{degrees[:3]}')
-    print(f'全ての人と近いアイドル:{closeness[:3]}')
-    print(f'様々なコミュニティに所属しているアイドル:{betweenness[:3]}')
-    print(f'最もポピュラーなアイドル:{eigenvectors[:3]}')
+    print(f'より多くの人と関わりを持っているアイドル:{top_k(nodes, centralities["degree"])}')
+    print(f'全ての人と近いアイドル:{top_k(nodes, centralities["closeness"])}')
+    print(f'様々なコミュニティに所属しているアイドル:{top_k(nodes, centralities["betweenness"])}')
+    print(f'最もポピュラーなアイドル:{top_k(nodes, centralities["eigenvector"])}')
 
     # 可視化
     nx.nx_agraph.view_pygraphviz(G, prog='fdp')
 
     # 度数分布をプロット
-    plt.bar(range(len(nx.degree_histogram(G))), height=nx.degree_histogram(G))
+    hist = nx.degree_histogram(G)
+    x = np.arange(len(hist))
+    plt.bar(x, height=hist)
     plt.title('Degree histgram')
     plt.xlabel('Number of degrees')
     plt.ylabel('Count')
-    plt.xticks(np.arange(0, len(nx.degree_histogram(G)), 1))
+    plt.xticks(x)
     plt.show()
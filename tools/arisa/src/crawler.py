@@ -1,8 +1,16 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import mimetypes
 import os
+from pathlib import Path
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
 import time
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlsplit, urlunparse, urlunsplit
 
 
 class Website:
@@ -53,39 +61,137 @@ class Content:
         print(f'IMAGE: {len(self.img)}')
 
 
+def _canon(url: str) -> str:
+    """
+    表記揺れで同じページを二重に取得しないよう，URLを正規化する．
+    フラグメントを除き，スキーム・ホストを小文字に揃え，クエリをキー順に並べる．
+
+    Args:
+        url (str): 正規化したいURL
+
+    Returns:
+        str: 正規化したURL
+    """
+
+    parts = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunparse(parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower(),
+                                     query=query, fragment=''))
+
+
+class RateLimiter:
+    """
+    スレッド間で共有するリクエスト間隔の制御クラス(leaky bucket)．
+
+    Attributes:
+        interval (float): リクエスト間の最小間隔[s]
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """前回のリクエストから最小間隔が空くまで待つ．"""
+
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def make_session() -> requests.Session:
+    """
+    コネクションプールを持つセッションを作成する．
+
+    Returns:
+        requests.Session: http/httpsでコネクションを使い回すセッション
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# 全てのクローラで共有するセッションとリクエスト間隔の制御，ページのキャッシュもこれを前提にURLだけをキーにする
+_SESSION = make_session()
+_LIMITER = RateLimiter(10.0)
+
+
+@lru_cache(maxsize=256)
+def _fetch(url: str) -> bytes:
+    """
+    GETリクエストの結果をバイト列でキャッシュする．
+    同じURLを取得する場合はクローラをまたいでリクエストを投げずにキャッシュを返す．
+
+    Args:
+        url (str): 取得したいWebページのURL
+
+    Returns:
+        bytes: Webページのコンテンツ
+    """
+
+    _LIMITER.acquire()
+    resp = _SESSION.get(url, timeout=10)
+    # エラーのレスポンスはキャッシュしない(例外はlru_cacheに保存されない)
+    resp.raise_for_status()
+    return resp.content
+
+
 class Crawler:
     """
     Webサイトのホームページから内部リンクを見つけ，コンテンツを取得するクラス．
 
     Attributes:
         site (Website): Webサイトの情報を格納したクラス
-        visited (set): 訪問したURLの集合
-        images_path (set): 取得する画像の集合
+        visited (set): 訪問したURL(正規化済み)の集合
+        images_path (set): 取得する画像の集合，サイトと同じホストの画像はパス部分のみを保持する
+        session (requests.Session): コネクションを使い回すためのセッション，全てのクローラで共有する
+        max_workers (int): 並列にリクエストを投げるスレッド数
+        limiter (RateLimiter): 負荷対策のリクエスト間隔の制御，全てのクローラで共有する
     """
 
-    def __init__(self, site: Website) -> None:
+    def __init__(self, site: Website, max_workers: int = 8) -> None:
         self.site = site
         self.visited = set()
         self.images_path = set()
-
-    def get_page(self, url: str) -> BeautifulSoup:
+        self._target_re = re.compile(site.target_pattern)
+        self._img_re = re.compile(r'\.png(?:\?|$)')
+        self._netloc = urlsplit(site.url).netloc
+        # ホームページからは対象ページへのリンクだけを取り出せば良い
+        self._link_strainer = SoupStrainer('a', href=self._target_re)
+        self._lock = threading.Lock()
+
+        self.session = _SESSION
+        self.max_workers = max_workers
+        self.limiter = _LIMITER
+
+    def get_page(self, url: str, parse_only: SoupStrainer = None) -> BeautifulSoup:
         """
         GETリクエストを投げて，WEBページのコンテンツを格納したBeautiful Soupオブジェクトを取得．
 
         Args:
             url (str): 取得したいWebページのURL
+            parse_only (SoupStrainer, optional): 指定した場合はマッチしたタグだけを木に格納する
 
         Returns:
             BeautifulSoup: Webページのコンテンツ
         """
 
+        # 取得済みのURLはキャッシュを使い，パースは呼び出しごとに行う
         try:
-            req = requests.get(url)
+            content = _fetch(url)
         except requests.exceptions.RequestException:
             return None
-        return BeautifulSoup(req.text, 'html.parser')
+        # バイト列のまま渡して，文字コードの判定はlxmlに任せる
+        return BeautifulSoup(content, 'lxml', parse_only=parse_only)
 
-    def safe_get(self, page_obj: BeautifulSoup, selector: str) -> str:
+    def safe_get(self, page_obj: BeautifulSoup, selector: str, multi: bool = False) -> str:
         """
         Beautiful Soupオブジェクトとタグ/CSSセレクタからコンテンツ文字列を取得する．
         セレクタでオブジェクトが見つからなかった場合は空文字列を返す．
@@ -93,17 +199,17 @@ class Crawler:
         Args:
             page_obj (BeautifulSoup): Webページのコンテンツを格納したオブジェクト
             selector (str): 抽出したいデータに関するタグ/CSSセレクタ
+            multi (bool, optional): Trueならマッチした全ての要素を改行で連結する，Falseなら最初の要素のみ
 
         Returns:
             str: コンテンツ文字列
         """
 
-        selected_elems = page_obj.select(selector)
+        if multi:
+            return '\n'.join(elem.get_text() for elem in page_obj.select(selector))
 
-        if selected_elems and (len(selected_elems) > 0):
-            return '\n'.join([elem.get_text() for elem in selected_elems])
-        else:
-            return ''
+        elem = page_obj.select_one(selector)
+        return elem.get_text() if elem else ''
 
     def img_download(self, save_dir: str) -> None:
         """
@@ -113,17 +219,40 @@ class Crawler:
             save_dir (str): 画像の保存先ディレクトリ
         """
 
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-
-        for i, path in enumerate(self.images_path):
-            img = requests.get(path).content
-            with open(os.path.join(save_dir, f'{i}.png'), 'wb') as f:
-                f.write(img)
-
-            # 負荷対策，10枚保存すれば1[s]待つ
-            if i % 10 == 0:
-                time.sleep(1)
+        save_dir = Path(save_dir)
+        save_dir.mkdir(parents=True, exist_ok=True)
+
+        def download(i: int, path: str) -> None:
+            url = urljoin(self.site.url, path)
+            # 負荷対策，リクエスト間隔をスレッド間で制御する
+            self.limiter.acquire()
+            try:
+                with self.session.get(url, stream=True, timeout=10) as r:
+                    r.raise_for_status()
+                    # 拡張子は画像のContent-Typeのときだけそれに従い，それ以外はリンク通りpngとして保存
+                    content_type = r.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                    ext = None
+                    if content_type.startswith('image/'):
+                        ext = mimetypes.guess_extension(content_type)
+                    ext = ext or '.png'
+                    file_path = save_dir / f'{i}{ext}'
+                    # メモリに溜めずに64KiBずつファイルへ書き出す
+                    # iter_contentなら途中で切断された場合もrequestsの例外になる
+                    try:
+                        with open(file_path, 'wb') as f:
+                            for chunk in r.iter_content(64 * 1024):
+                                f.write(chunk)
+                    except (requests.exceptions.RequestException, OSError):
+                        file_path.unlink(missing_ok=True)  # 書きかけのファイルは残さない
+                        raise
+            # 取得できない画像があってもクロール全体は止めずに次の画像へ進む
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f'{url}: {e}')
+
+        with ThreadPoolExecutor(self.max_workers) as ex:
+            futures = [ex.submit(download, i, path) for i, path in enumerate(self.images_path)]
+            for future in futures:
+                future.result()
 
     def parse(self, url: str) -> None:
         """
@@ -140,37 +269,56 @@ class Crawler:
             body = self.safe_get(bs, self.site.body_tag)
 
             # 画像のリンクを取得
-            img_obj = bs.find_all('a', {'href': re.compile('.*png')})
-            images_path = set([img.attrs['href'] for img in img_obj])
-            self.images_path |= images_path
+            img_obj = bs.find_all('a', {'href': self._img_re})
+            images_path = {self._short_path(url, img.attrs['href']) for img in img_obj}
 
-            if (title != '') and (body != ''):
-                content = Content(url, title, body, images_path)
-                content.print()
+            # 複数スレッドから呼ばれるので，集合の更新と出力はまとめて行う
+            with self._lock:
+                self.images_path |= images_path
+
+                if (title != '') and (body != ''):
+                    content = Content(url, title, body, images_path)
+                    content.print()
+
+    def _short_path(self, page_url: str, href: str) -> str:
+        """
+        画像のリンクを保持用の短い文字列にする．
+        サイトと同じホストならパス(とクエリ)のみにしてinternし，別ホストならURLのまま返す．
+        ダウンロード時にurljoin(self.site.url, path)で元のURLに戻せる．
+
+        Args:
+            page_url (str): リンクが含まれていたページのURL
+            href (str): 画像のリンク
+
+        Returns:
+            str: 保持用の画像のパス
+        """
+
+        parts = urlsplit(urljoin(page_url, href))
+        if parts.netloc == self._netloc:
+            return sys.intern(urlunsplit(('', '', parts.path, parts.query, '')))
+        return sys.intern(parts.geturl())
 
     def crawl(self) -> None:
         """Webサイトのホームページからのリンクを取得"""
 
-        bs = self.get_page(self.site.url)
-        pattern = re.compile(self.site.target_pattern)
-        target_pages = bs.find_all('a', href=pattern)
-        count = 0
+        bs = self.get_page(self.site.url, parse_only=self._link_strainer)
+        target_pages = bs.find_all('a', href=self._target_re)
 
+        # 訪れたページじゃなければ探索対象にする
+        urls = []
         for target_page in target_pages:
             target_page = target_page.attrs['href']
-
-            # 訪れたページじゃなければ探索
+            if not self.site.absolute_url:
+                target_page = f'{self.site.url}{target_page}'
+            target_page = _canon(target_page)
             if target_page not in self.visited:
                 self.visited.add(target_page)
-                if not self.site.absolute_url:
-                    target_page = f'{self.site.url}{target_page}'
-                self.parse(target_page)
-
-            # 負荷対策，10アクセスしたら1[s]待つ
-            # break
-            count += 1
-            if count % 10 == 0:
-                time.sleep(1)
+                urls.append(target_page)
+
+        # 負荷対策はget_page内のRateLimiterで行う
+        with ThreadPoolExecutor(self.max_workers) as ex:
+            list(ex.map(self.parse, urls))
 
 
 if __name__ == '__main__':
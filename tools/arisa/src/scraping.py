@@ -1,7 +1,17 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from functools import lru_cache
 import re
-from urllib.error import HTTPError
-from urllib.request import urlopen
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Union
+from urllib3.util.retry import Retry
+
+# 同じホストへのアクセスでコネクションを使い回す
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_maxsize=16,
+                       max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504)))
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
 
 
 def get_title(url: str) -> str:
@@ -18,32 +28,43 @@ def get_title(url: str) -> str:
         <h1>ログイン</h1>
     """
 
-    # サーバにアクセスできたか
+    # サーバにアクセスでき，ページのコンテンツを取得できたか
     try:
-        html = urlopen(url)
-    except HTTPError as e:
-        print(e)
-        return None
-
-    # ページのコンテンツを取得できたか
-    try:
-        bs = BeautifulSoup(html.read(), 'html.parser')
+        resp = _SESSION.get(url, timeout=10)
+        resp.raise_for_status()
+        bs = BeautifulSoup(resp.content, 'lxml')
         title = bs.body.h1
-    except AttributeError as e:
+    except (requests.RequestException, AttributeError) as e:
         print(e)
         return None
 
     return title
 
 
-def get_idol_links(url: str, idol: str = '') -> list:
+@lru_cache(maxsize=256)
+def _get_links_soup(url: str) -> BeautifulSoup:
+    """get web page parsed only with a tags, cached by url.
+
+    Args:
+        url (str): web page url
+
+    Returns:
+        BeautifulSoup: parsed a tags of the web page, treat as read-only
+    """
+
+    resp = _SESSION.get(url, timeout=10)
+    resp.raise_for_status()
+    return BeautifulSoup(resp.content, 'lxml', parse_only=SoupStrainer('a'))
+
+
+def get_idol_links(url: str, idol: Union[str, re.Pattern] = '') -> list:
     """
     get character page links with a href tag.
     if not set idol name, get all links.
 
     Args:
         url (str): web page url
-        idol (str, optional): idol name, defaults to ''
+        idol (Union[str, re.Pattern], optional): idol name or precompiled title pattern, defaults to ''
 
     Returns:
         list: links from url
@@ -53,9 +74,10 @@ def get_idol_links(url: str, idol: str = '') -> list:
         ['https://imas.gamedbs.jp/mlth/chara/show/51']
     """
 
-    html = urlopen(url)
-    bs = BeautifulSoup(html.read(), 'html.parser')
-    results = bs.find_all('a', {'title': re.compile(f'.*{idol}.*')})
+    # 同じページは一度だけ取得し，キャッシュした木からidolで絞り込む
+    bs = _get_links_soup(url)
+    pattern = idol if isinstance(idol, re.Pattern) else re.compile(idol)
+    results = bs.find_all('a', {'title': pattern})
     links = [res.attrs['href'] for res in results]
 
     return links